@@ -1,153 +1,637 @@
 # travel_assistant.py
 import os
+import re
 import time
+import random
+import textwrap
 import json
+import asyncio
+import hashlib
 import logging
-import requests
+import sqlite3
+import threading
+import httpx
 import streamlit as st
 from datetime import datetime, timedelta
-from typing import Dict, List, Any
+from typing import TYPE_CHECKING, Callable, Dict, List, Any, Optional, Tuple
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+if TYPE_CHECKING:
+    # numpy is only needed by the opt-in semantic cache, so it is imported on first use
+    import numpy as np
+
+@st.cache_resource(show_spinner=False)
+def _init_logging() -> logging.Logger:
+    """Configure logging once per server process rather than on every rerun"""
+    logging.basicConfig(level=logging.INFO)
+    return logging.getLogger(__name__)
+
+logger = _init_logging()
 
 # Ollama API configuration
 OLLAMA_API_URL = "http://localhost:11434/api/generate"
+OLLAMA_EMBED_URL = "http://localhost:11434/api/embeddings"
 OLLAMA_MODEL = "llama3.2:latest"
+OLLAMA_EMBED_MODEL = "nomic-embed-text"
+# How long Ollama keeps the model resident after the last request
+OLLAMA_KEEP_ALIVE = "30m"
+
+# Let Ollama serve the five agents in parallel instead of queueing them.
+# These are read by `ollama serve`, so they only apply to a server started
+# from this environment; an already running server keeps its own settings.
+os.environ.setdefault("OLLAMA_NUM_PARALLEL", "5")
+os.environ.setdefault("OLLAMA_MAX_LOADED_MODELS", "1")
+
+def env_int(name: str, default: int, low: int, high: int) -> int:
+    """Read an integer env var, falling back on bad values and clamping to [low, high]"""
+    try:
+        value = int(os.environ.get(name, default))
+    except ValueError:
+        logger.warning(f"Ignoring non-integer {name}={os.environ[name]!r}")
+        value = default
+    return min(max(value, low), high)
+
+# Re-render streamed output every this many tokens
+STREAM_RENDER_EVERY = 20
+
+# Response cache configuration
+CACHE_DB_PATH = os.path.expanduser("~/.travel_assistant_cache.db")
+CACHE_TTL_SECONDS = 24 * 60 * 60
+# Cosine similarity above which a cached answer to a different prompt is reused
+SIMILARITY_THRESHOLD = 0.92
+# How many of the most recent embeddings a semantic lookup compares against
+SIMILARITY_CANDIDATES = 256
+
+# (preamble text, Ollama context token ids, user_input fields in the preamble)
+# shared by the agents of one run; the ids are None when the preamble was not
+# primed and is sent inline instead
+SharedContext = Tuple[str, Optional[List[int]], Tuple[str, ...]]
 
 # Initialize session state
 if 'results' not in st.session_state:
     st.session_state.results = {}
 if 'processing' not in st.session_state:
     st.session_state.processing = False
+if 'agent_results' not in st.session_state:
+    st.session_state.agent_results = {}
+
+class PromptCache:
+    """SQLite-backed store of LLM responses keyed by model and exact prompt
+    
+    Responses stored with a prompt embedding can also be found by cosine
+    similarity, within the same model and system prompt (the `scope`).
+    """
+
+    def __init__(self, path: str, ttl: int = CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT, ts INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, scope TEXT, vec BLOB)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_scope ON embeddings (scope)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_ts ON responses (ts)")
+        with self._lock:
+            self._purge()
+            self._conn.commit()
+
+    def _purge(self) -> None:
+        """Delete expired responses and their embeddings; caller holds the lock"""
+        cutoff = int(time.time() - self.ttl)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM responses WHERE ts < ?)", (cutoff,)
+        )
+        self._conn.execute("DELETE FROM responses WHERE ts < ?", (cutoff,))
+
+    @staticmethod
+    def _key(prompt: str, system: str) -> str:
+        return hashlib.sha256((OLLAMA_MODEL + "\0" + system + "\0" + prompt).encode()).hexdigest()
+
+    @staticmethod
+    def _scope(system: str) -> str:
+        return hashlib.sha256((OLLAMA_MODEL + "\0" + system).encode()).hexdigest()
+
+    def get(self, prompt: str, system: str = "") -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, ts FROM responses WHERE key = ?", (self._key(prompt, system),)
+            ).fetchone()
+        if row and time.time() - row[1] < self.ttl:
+            return row[0]
+        return None
+
+    def get_similar(self, system: str, vec: "np.ndarray") -> Optional[str]:
+        """Return the most similar cached response if it clears SIMILARITY_THRESHOLD"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.response, e.vec FROM embeddings e JOIN responses r ON r.key = e.key "
+                "WHERE e.scope = ? AND r.ts >= ? ORDER BY r.ts DESC LIMIT ?",
+                (self._scope(system), int(time.time() - self.ttl), SIMILARITY_CANDIDATES)
+            ).fetchall()
+        if not rows:
+            return None
+        import numpy as np
+        # Stored vectors are unit length, so dot products are cosine similarities
+        matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        sims = np.einsum("ij,j->i", matrix, vec)
+        best = int(np.argmax(sims))
+        if sims[best] > SIMILARITY_THRESHOLD:
+            logger.info(f"Semantic cache hit (similarity {sims[best]:.3f})")
+            return rows[best][0]
+        return None
+
+    def set(self, prompt: str, system: str, response: str, vec: Optional["np.ndarray"] = None) -> None:
+        key = self._key(prompt, system)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+                (key, response, int(time.time()))
+            )
+            if vec is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, scope, vec) VALUES (?, ?, ?)",
+                    (key, self._scope(system), vec.astype("float32").tobytes())
+                )
+            self._purge()
+            self._conn.commit()
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_cache() -> PromptCache:
+    """Open the response cache once and keep it across Streamlit reruns"""
+    return PromptCache(CACHE_DB_PATH)
+
+# Connection pool limits used by both the sync and the async clients. Plain-http
+# Ollama negotiates HTTP/1.1 with keep-alive; the http2 flag applies over TLS.
+HTTP_LIMITS = httpx.Limits(max_connections=8, max_keepalive_connections=8)
+
+@st.cache_resource(show_spinner=False)
+def get_http_client() -> httpx.Client:
+    """Pooled client for the synchronous model warm-up, kept across reruns"""
+    # Transport-level retries re-attempt failed connects before any backoff kicks in
+    return httpx.Client(
+        timeout=120,
+        transport=httpx.HTTPTransport(http2=True, limits=HTTP_LIMITS, retries=2)
+    )
+
+@st.cache_resource(show_spinner=False)
+def _warmup() -> threading.Thread:
+    """Load the model into memory once per server so the first plan skips the cold start"""
+    def load_model():
+        try:
+            get_http_client().post(OLLAMA_API_URL, json={
+                "model": OLLAMA_MODEL,
+                "prompt": " ",
+                "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                "options": {"num_predict": 1}
+            }).raise_for_status()
+            logger.info(f"Warmed up {OLLAMA_MODEL}")
+        except httpx.HTTPError as e:
+            logger.warning(f"Model warm-up failed: {str(e)}")
+    
+    # Load in the background so the first page render is not held up
+    thread = threading.Thread(target=load_model, daemon=True)
+    thread.start()
+    return thread
+
+_warmup()
+
+def new_async_client() -> httpx.AsyncClient:
+    """Create the pooled client that carries all agent traffic in one planning run"""
+    # An AsyncClient is bound to the event loop it was first used on, and
+    # asyncio.run() creates a fresh loop per run, so the pool lives per run.
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS, retries=2)
+    )
+
+async def ollama_embed(client: httpx.AsyncClient, text: str) -> Optional["np.ndarray"]:
+    """Embed `text` with the local embedding model; None if it is unavailable"""
+    import numpy as np
+    try:
+        response = await client.post(
+            OLLAMA_EMBED_URL, json={"model": OLLAMA_EMBED_MODEL, "prompt": text}, timeout=30
+        )
+        response.raise_for_status()
+        vec = np.asarray(response.json()["embedding"], dtype=np.float32)
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        logger.warning(f"Embedding failed, skipping semantic cache: {str(e)}")
+        return None
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else None
 
 # Custom LLM function with retry logic
-def query_llama(prompt: str, max_retries: int = 3, timeout: int = 120) -> str:
-    """Query Ollama API with retry logic"""
+async def query_llama_async(client: httpx.AsyncClient, prompt: str, system: str = "",
+                            placeholder: Optional[Any] = None, fmt: Optional[str] = None,
+                            shared: Optional[SharedContext] = None,
+                            max_retries: int = 3, timeout: int = 120, max_wait: float = 10) -> str:
+    """Query Ollama API asynchronously with retry logic, streaming tokens into `placeholder`
+    
+    With `shared`, the prompt continues from an already evaluated preamble.
+    Replies in a structured `fmt` bypass the response cache; the caller stores
+    them once they have been validated.
+    """
+    # The reply depends on the preamble too, so it is part of what gets cached
+    cache_prompt = prompt if shared is None else shared[0] + "\n\n" + prompt
+    use_cache = fmt is None
+    cache = get_prompt_cache()
+    cached = cache.get(cache_prompt, system) if use_cache else None
+    vec = None
+    if cached is None and use_cache and st.session_state.get("semantic_cache", False):
+        vec = await ollama_embed(client, cache_prompt)
+        if vec is not None:
+            cached = cache.get_similar(system, vec)
+    if cached is not None:
+        logger.info(f"Cache hit for prompt: {prompt[:50]}...")
+        if placeholder is not None:
+            placeholder.markdown(cached)
+        return cached
+    
     payload = {
         "model": OLLAMA_MODEL,
         "prompt": prompt,
-        "stream": False,
+        "system": system,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {"temperature": 0.3}
     }
+    if fmt:
+        payload["format"] = fmt
+    if shared is not None:
+        if shared[1] is not None:
+            payload["context"] = shared[1]
+        else:
+            payload["prompt"] = cache_prompt
     
     for attempt in range(max_retries):
         try:
-            response = requests.post(
-                OLLAMA_API_URL,
-                json=payload,
-                timeout=timeout
-            )
-            response.raise_for_status()
+            buffer = ""
+            async with client.stream("POST", OLLAMA_API_URL, json=payload, timeout=timeout) as response:
+                response.raise_for_status()
+                
+                # Each line is one JSON chunk carrying the next token(s)
+                tokens = 0
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    # The closing chunk holds no text, just timings and the long
+                    # `context` token array, so stop without decoding it
+                    if '"done":true' in line:
+                        break
+                    chunk = json.loads(line)
+                    if "response" not in chunk:
+                        logger.error(f"Unexpected response format: {chunk}")
+                        return "Error: Invalid response format from LLM"
+                    buffer += chunk["response"]
+                    tokens += 1
+                    if placeholder is not None and tokens % STREAM_RENDER_EVERY == 0:
+                        placeholder.markdown(buffer)
+                    if chunk.get("done"):
+                        break
             
-            # Parse response
-            response_data = response.json()
-            if "response" in response_data:
-                return response_data["response"]
-            else:
-                logger.error(f"Unexpected response format: {response_data}")
-                return "Error: Invalid response format from LLM"
+            if placeholder is not None:
+                placeholder.markdown(buffer)
+            if use_cache:
+                cache.set(cache_prompt, system, buffer, vec)
+            return buffer
                 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Attempt {attempt+1} failed: {str(e)}")
             if attempt < max_retries - 1:
-                wait_time = 2 ** attempt  # Exponential backoff
-                logger.info(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
+                # Capped exponential backoff, jittered so parallel agents don't retry in lockstep
+                wait_time = min(2 ** attempt, max_wait) + random.uniform(0, 0.5)
+                logger.info(f"Retrying in {wait_time:.1f} seconds...")
+                await asyncio.sleep(wait_time)
             else:
                 logger.error(f"All retries failed for prompt: {prompt[:50]}...")
                 return f"Error: LLM request failed after {max_retries} attempts"
     
     return "Error: LLM request failed"
 
-# Agent functions
-def planner_agent(user_input: Dict[str, Any]) -> str:
-    prompt = f"""
-    You are a Senior Travel Planner. Create a {user_input['duration']}-day itinerary for a trip from {
-        user_input['start_date']} to {user_input['end_date']}.
-    Destination: {user_input['destination']}
-    Travelers: {user_input['num_people']} {user_input['traveler_type']} travelers
-    Special requests: {user_input['special_requests']}
-    
-    Output format:
-    # Travel Itinerary for {user_input['destination']}
-    ## Day 1: [Date]
-    - [Time]: [Activity]
-    - [Time]: [Activity]
-    ...
-    """
-    return query_llama(prompt)
+# Sections returned by the single-request planner, in display order
+PLAN_SECTIONS = ("itinerary", "experiences", "recommendations", "safety", "budget", "packing")
 
-def experience_agent(user_input: Dict[str, Any]) -> str:
-    prompt = f"""
-    You are a Local Experience Specialist. Recommend activities in {user_input['destination']} for {
-        user_input['traveler_type']} travelers.
-    Special requests: {user_input['special_requests']}
-    
-    Output format:
-    # Local Experiences in {user_input['destination']}
-    ## Must-Try Activities
-    - [Activity 1]: [Description]
-    - [Activity 2]: [Description]
-    
-    ## Cultural Experiences
-    - [Experience 1]: [Description]
-    """
-    return query_llama(prompt)
+# Heading that starts the packing list inside the budget agent's reply
+_PACKING_RE = re.compile(r"^#+\s*Packing List", re.MULTILINE)
 
-def recommendation_agent(user_input: Dict[str, Any]) -> str:
-    prompt = f"""
-    You are a Hospitality Concierge. Recommend hotels and transport in {user_input['destination']} for {
-        user_input['num_people']} {user_input['traveler_type']} travelers.
-    Budget level: {user_input['budget_level']}
-    
-    Output format:
-    # Accommodations & Transport
-    ## Hotels
-    - [Option 1]: [Price range], [Features]
-    
-    ## Transportation
-    - [Option 1]: [Description]
-    """
-    return query_llama(prompt)
+# user_input fields each agent's prompt reads; an agent is only re-run when one changes
+PLANNER_KEYS = ("duration", "start_date", "end_date", "destination", "num_people",
+                "traveler_type", "special_requests")
+EXPERIENCE_KEYS = ("destination", "traveler_type", "special_requests")
+RECOMMENDATION_KEYS = ("destination", "num_people", "traveler_type", "budget_level")
+SAFETY_KEYS = ("destination", "start_date", "end_date")
+BUDGET_KEYS = ("num_people", "destination", "duration")
 
-def safety_agent(user_input: Dict[str, Any]) -> str:
-    prompt = f"""
-    You are a Travel Security Advisor. Provide safety tips for {user_input['destination']} during {
-        user_input['start_date']} to {user_input['end_date']}.
-    
-    Output format:
-    # Safety Information
-    ## Travel Advisories
-    - [Advisory 1]
+# Static agent preambles, sent through Ollama's `system` field so the
+# identical role and format tokens are not re-prefilled on every request
+PLANNER_SYSTEM = """You are a Senior Travel Planner. Create day-by-day travel itineraries.
+
+Output format:
+# Travel Itinerary for [Destination]
+## Day 1: [Date]
+- [Time]: [Activity]
+- [Time]: [Activity]
+...
+"""
+
+EXPERIENCE_SYSTEM = """You are a Local Experience Specialist. Recommend activities for the given travelers.
+
+Output format:
+# Local Experiences in [Destination]
+## Must-Try Activities
+- [Activity 1]: [Description]
+- [Activity 2]: [Description]
+
+## Cultural Experiences
+- [Experience 1]: [Description]
+"""
+
+RECOMMENDATION_SYSTEM = """You are a Hospitality Concierge. Recommend hotels and transport for the given travelers.
+
+Output format:
+# Accommodations & Transport
+## Hotels
+- [Option 1]: [Price range], [Features]
+
+## Transportation
+- [Option 1]: [Description]
+"""
+
+SAFETY_SYSTEM = """You are a Travel Security Advisor. Provide safety tips for the given trip.
+
+Output format:
+# Safety Information
+## Travel Advisories
+- [Advisory 1]
+
+## Health Recommendations
+- [Recommendation 1]
+
+## Emergency Contacts
+- [Contact 1]
+"""
+
+BUDGET_SYSTEM = """You are a Travel Finance Manager. Estimate trip costs and suggest packing items.
+
+Output format:
+# Budget Estimate
+## Cost Breakdown
+- Accommodation: [Estimate]
+- Transportation: [Estimate]
+- Total: [Total Estimate]
+
+# Packing List
+- [Category 1]
+  - [Item 1]
+  - [Item 2]
+"""
+
+# Per-request prompt templates, filled from user_input with str.format_map
+PLANNER_TMPL = textwrap.dedent("""
+    Create a {duration}-day itinerary for a trip from {start_date} to {end_date}.
+    Destination: {destination}
+    Travelers: {num_people} {traveler_type} travelers
+    Special requests: {special_requests}
+""").strip()
+
+EXPERIENCE_TMPL = textwrap.dedent("""
+    Recommend activities in {destination} for {traveler_type} travelers.
+    Special requests: {special_requests}
+""").strip()
+
+RECOMMENDATION_TMPL = textwrap.dedent("""
+    Recommend hotels and transport in {destination} for {num_people} {traveler_type} travelers.
+    Budget level: {budget_level}
+""").strip()
+
+SAFETY_TMPL = textwrap.dedent("""
+    Provide safety tips for {destination} during {start_date} to {end_date}.
+""").strip()
+
+BUDGET_TMPL = textwrap.dedent("""
+    Estimate costs for {num_people} people traveling to {destination} for {duration} days. Also suggest packing items.
+""").strip()
+
+# Labels for user_input fields written into the shared preamble and task tails,
+# in the order they are written
+FIELD_LABELS = {
+    "destination": "Destination",
+    "start_date": "Start date",
+    "end_date": "End date",
+    "duration": "Duration (days)",
+    "num_people": "Number of travelers",
+    "traveler_type": "Traveler type",
+    "budget_level": "Budget level",
+    "special_requests": "Special requests",
+}
+
+PLANNER_TASK = "Create the day-by-day itinerary for the trip above."
+EXPERIENCE_TASK = "Recommend activities for the travelers above, honoring their special requests."
+RECOMMENDATION_TASK = "Recommend hotels and transport for the travelers above at their budget level."
+SAFETY_TASK = "Provide safety tips for the destination and dates above."
+BUDGET_TASK = "Estimate costs for the trip above. Also suggest packing items."
+
+MEGA_TMPL = textwrap.dedent("""
+    You are a team of travel experts planning a {duration}-day trip from {start_date} to {end_date}.
+    Destination: {destination}
+    Travelers: {num_people} {traveler_type} travelers
+    Budget level: {budget_level}
+    Special requests: {special_requests}
     
-    ## Health Recommendations
-    - [Recommendation 1]
+    Respond with a JSON object with exactly these string keys, each value a markdown section:
+    - "itinerary": day-by-day schedule with times and activities
+    - "experiences": must-try activities and cultural experiences
+    - "recommendations": hotels with price ranges and transportation options
+    - "safety": travel advisories, health recommendations and emergency contacts
+    - "budget": cost breakdown for accommodation, transportation and total
+    - "packing": packing list grouped by category
+""").strip()
+
+# Agent functions
+async def planner_agent(user_input: Dict[str, Any], client: httpx.AsyncClient,
+                        placeholder: Optional[Any] = None, shared: Optional[SharedContext] = None) -> str:
+    prompt = (shared_prompt(PLANNER_TASK, user_input, PLANNER_KEYS, shared) if shared
+              else PLANNER_TMPL.format_map(user_input))
+    return await query_llama_async(client, prompt, system=PLANNER_SYSTEM,
+                                   placeholder=placeholder, shared=shared)
+
+async def experience_agent(user_input: Dict[str, Any], client: httpx.AsyncClient,
+                           placeholder: Optional[Any] = None, shared: Optional[SharedContext] = None) -> str:
+    prompt = (shared_prompt(EXPERIENCE_TASK, user_input, EXPERIENCE_KEYS, shared) if shared
+              else EXPERIENCE_TMPL.format_map(user_input))
+    return await query_llama_async(client, prompt, system=EXPERIENCE_SYSTEM,
+                                   placeholder=placeholder, shared=shared)
+
+async def recommendation_agent(user_input: Dict[str, Any], client: httpx.AsyncClient,
+                               placeholder: Optional[Any] = None, shared: Optional[SharedContext] = None) -> str:
+    prompt = (shared_prompt(RECOMMENDATION_TASK, user_input, RECOMMENDATION_KEYS, shared) if shared
+              else RECOMMENDATION_TMPL.format_map(user_input))
+    return await query_llama_async(client, prompt, system=RECOMMENDATION_SYSTEM,
+                                   placeholder=placeholder, shared=shared)
+
+async def safety_agent(user_input: Dict[str, Any], client: httpx.AsyncClient,
+                       placeholder: Optional[Any] = None, shared: Optional[SharedContext] = None) -> str:
+    prompt = (shared_prompt(SAFETY_TASK, user_input, SAFETY_KEYS, shared) if shared
+              else SAFETY_TMPL.format_map(user_input))
+    return await query_llama_async(client, prompt, system=SAFETY_SYSTEM,
+                                   placeholder=placeholder, shared=shared)
+
+async def budget_agent(user_input: Dict[str, Any], client: httpx.AsyncClient,
+                       placeholder: Optional[Any] = None, shared: Optional[SharedContext] = None) -> str:
+    prompt = (shared_prompt(BUDGET_TASK, user_input, BUDGET_KEYS, shared) if shared
+              else BUDGET_TMPL.format_map(user_input))
+    return await query_llama_async(client, prompt, system=BUDGET_SYSTEM,
+                                   placeholder=placeholder, shared=shared)
+
+def trip_details(user_input: Dict[str, Any], keys: Tuple[str, ...]) -> str:
+    """Render the given user_input fields as labelled lines"""
+    return "\n".join(f"{FIELD_LABELS[k]}: {user_input[k]}" for k in FIELD_LABELS if k in keys)
+
+def shared_prompt(task: str, user_input: Dict[str, Any], keys: Tuple[str, ...],
+                  shared: SharedContext) -> str:
+    """Agent prompt sent after the shared preamble, adding the fields it lacks"""
+    rest = tuple(k for k in keys if k not in shared[2])
+    return f"More trip details:\n{trip_details(user_input, rest)}\n\n{task}" if rest else task
+
+async def prime_shared_context(client: httpx.AsyncClient, preamble: str) -> Optional[List[int]]:
+    """Have Ollama evaluate the trip preamble once and return its context tokens"""
+    try:
+        response = await client.post(OLLAMA_API_URL, json={
+            "model": OLLAMA_MODEL,
+            "prompt": preamble,
+            "stream": False,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {"num_predict": 1}
+        }, timeout=120)
+        response.raise_for_status()
+        return response.json()["context"]
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        logger.warning(f"Could not prime shared context, sending full prompts: {str(e)}")
+        return None
+
+def input_hash(user_input: Dict[str, Any], keys: Tuple[str, ...]) -> str:
+    """Hash the subset of user_input an agent consumes"""
+    subset = {k: user_input[k] for k in keys}
+    return hashlib.md5(json.dumps(subset, sort_keys=True).encode()).hexdigest()
+
+# (system prompt, task sent after the shared preamble) per results key
+SHARED_TASKS = {
+    "itinerary": (PLANNER_SYSTEM, PLANNER_TASK),
+    "experiences": (EXPERIENCE_SYSTEM, EXPERIENCE_TASK),
+    "recommendations": (RECOMMENDATION_SYSTEM, RECOMMENDATION_TASK),
+    "safety": (SAFETY_SYSTEM, SAFETY_TASK),
+    "budget": (BUDGET_SYSTEM, BUDGET_TASK),
+}
+
+# (results key, agent, user_input fields it reads)
+AGENTS = [
+    ("itinerary", planner_agent, PLANNER_KEYS),
+    ("experiences", experience_agent, EXPERIENCE_KEYS),
+    ("recommendations", recommendation_agent, RECOMMENDATION_KEYS),
+    ("safety", safety_agent, SAFETY_KEYS),
+    ("budget", budget_agent, BUDGET_KEYS),
+]
+
+async def run_agents(user_input: Dict[str, Any], placeholders: Dict[str, Any],
+                     previous: Dict[str, Tuple[str, str]],
+                     on_done: Optional[Callable[[str], None]] = None,
+                     max_parallel: int = 5) -> Dict[str, Tuple[str, str]]:
+    """Run the agents concurrently, reusing previous results whose inputs are unchanged
     
-    ## Emergency Contacts
-    - [Contact 1]
+    Both `previous` and the return value map a results key to (input hash, result).
+    `on_done` is called with each results key as soon as that agent finishes.
+    At most `max_parallel` requests are sent to Ollama at once.
     """
-    return query_llama(prompt)
-
-def budget_agent(user_input: Dict[str, Any]) -> str:
-    prompt = f"""
-    You are a Travel Finance Manager. Estimate costs for {user_input['num_people']} people traveling to {
-        user_input['destination']} for {user_input['duration']} days. Also suggest packing items.
+    limit = asyncio.Semaphore(max_parallel)
+    digests = {name: input_hash(user_input, keys) for name, _, keys in AGENTS}
+    stale = [name for name in digests if previous.get(name, ("",))[0] != digests[name]]
     
-    Output format:
-    # Budget Estimate
-    ## Cost Breakdown
-    - Accommodation: [Estimate]
-    - Transportation: [Estimate]
-    - Total: [Total Estimate]
+    async def run_one(name, agent, keys, client):
+        if name not in stale:
+            logger.info(f"Inputs unchanged, reusing previous {name}")
+            if placeholders.get(name) is not None:
+                placeholders[name].markdown(previous[name][1])
+            return name, previous[name]
+        async with limit:
+            return name, (digests[name], await agent(user_input, client, placeholders.get(name), shared))
     
-    # Packing List
-    - [Category 1]
-      - [Item 1]
-      - [Item 2]
-    """
-    return query_llama(prompt)
+    outputs = {}
+    async with new_async_client() as client:
+        # Sharing the preamble only pays off when several agents reuse it. It holds
+        # only the fields every stale agent reads, so each reply still depends on
+        # just its own keys; priming is skipped when every stale agent is cached.
+        shared = None
+        keys_of = {name: keys for name, _, keys in AGENTS}
+        common = tuple(k for k in FIELD_LABELS if all(k in keys_of[name] for name in stale))
+        if len(stale) > 1 and common:
+            preamble = "Trip details:\n" + trip_details(user_input, common)
+            shared = (preamble, None, common)
+            cache = get_prompt_cache()
+            if not all(cache.get(preamble + "\n\n" + shared_prompt(SHARED_TASKS[name][1], user_input,
+                                                                    keys_of[name], shared),
+                                 SHARED_TASKS[name][0])
+                       for name in stale):
+                context = await prime_shared_context(client, preamble)
+                # Without primed tokens the agents send their full standalone prompts
+                shared = (preamble, context, common) if context is not None else None
+        for finished in asyncio.as_completed([
+            run_one(name, agent, keys, client) for name, agent, keys in AGENTS
+        ]):
+            name, entry = await finished
+            outputs[name] = entry
+            if on_done is not None:
+                on_done(name)
+    return outputs
+
+def split_budget_and_packing(budget_result: str) -> Tuple[str, str]:
+    """Split the budget agent's reply into its budget and packing list sections"""
+    parts = _PACKING_RE.split(budget_result, maxsplit=1)
+    if len(parts) == 2:
+        return parts[0], "# Packing List" + parts[1]
+    return budget_result, "Packing list not generated"
+
+def mega_prompt(user_input: Dict[str, Any]) -> str:
+    """Build one prompt asking for every plan section as a JSON object"""
+    return MEGA_TMPL.format_map(user_input)
+
+async def run_single_request(user_input: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    """Plan every section with one JSON-mode LLM call; None if the reply is unusable"""
+    prompt = mega_prompt(user_input)
+    cache = get_prompt_cache()
+    raw = cache.get(prompt)
+    if raw is not None:
+        logger.info("Cache hit for single-request plan")
+    else:
+        async with new_async_client() as client:
+            raw = await query_llama_async(client, prompt, fmt="json")
+    try:
+        plan = json.loads(raw)
+    except json.JSONDecodeError:
+        logger.warning(f"Single-request plan was not valid JSON: {raw[:50]}...")
+        return None
+    if not isinstance(plan, dict):
+        return None
+    # Nested or missing sections would render as a Python repr; let the agents redo them
+    missing = [s for s in PLAN_SECTIONS if not isinstance(plan.get(s), str) or not plan[s].strip()]
+    if missing:
+        logger.warning(f"Single-request plan is missing sections: {', '.join(missing)}")
+        return None
+    # Only usable replies are cached, so a bad one is retried next time
+    cache.set(prompt, "", raw)
+    return {section: plan[section] for section in PLAN_SECTIONS}
+
+@st.cache_data(show_spinner=False)
+def _encode_results(blob: Tuple[Tuple[str, str], ...]) -> str:
+    """Serialize the results for download once per distinct plan, not on every rerun"""
+    return json.dumps(dict(blob), indent=2)
+
+def claim_planning_run(dates_valid: bool) -> None:
+    """Plan button callback: mark a plan as in flight before the next run draws the page"""
+    if dates_valid:
+        st.session_state.in_flight = True
 
 # Streamlit UI Setup
 st.set_page_config(
@@ -181,14 +665,19 @@ with st.sidebar:
     budget_level = st.selectbox("Budget Level", ["Budget", "Mid-range", "Luxury"])
     special_requests = st.text_area("Special Requirements", "Vegetarian food, accessible locations")
     
-    if st.button("Plan My Trip", use_container_width=True, type="primary"):
+    # The click callback runs before the next script run, so the button is
+    # already disabled when it is drawn in the run that plans the trip
+    if st.button("Plan My Trip", use_container_width=True, type="primary",
+                 disabled=st.session_state.get("in_flight", False),
+                 on_click=claim_planning_run, args=(start_date < end_date,)):
         if start_date >= end_date:
             st.error("End date must be after start date")
+            st.session_state.in_flight = False
         else:
             st.session_state.processing = True
             st.session_state.user_input = {
-                "start_date": str(start_date),
-                "end_date": str(end_date),
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
                 "duration": (end_date - start_date).days,
                 "from_location": from_location,
                 "destination": destination,
@@ -197,47 +686,88 @@ with st.sidebar:
                 "budget_level": budget_level,
                 "special_requests": special_requests
             }
+    
+    with st.expander("Advanced"):
+        # Per session: os.environ is shared by every session on the server and
+        # doesn't reach an Ollama server that is already running
+        st.number_input(
+            "Parallel agent requests", 1, 16, env_int("OLLAMA_NUM_PARALLEL", 5, 1, 16),
+            key="max_parallel",
+            help="Agent requests sent to Ollama at once; match the server's OLLAMA_NUM_PARALLEL"
+        )
+        st.toggle(
+            "Reuse answers to similar requests", key="semantic_cache",
+            help=f"Serve a cached answer when a new prompt embeds within cosine {SIMILARITY_THRESHOLD} "
+                 f"of an earlier one (needs `ollama pull {OLLAMA_EMBED_MODEL}`). Prompts that differ "
+                 "only in a destination or date can score this high, so check results."
+        )
+        single_request = st.toggle(
+            "Single request mode",
+            help="Generate every section in one LLM call instead of five separate agents"
+        )
 
 # Main Content
 st.title("AI Travel Assistant ✈️")
 st.caption("Your personal travel planning expert powered by Ollama's LLaMA 3")
 
 # Processing
+# `in_flight` stays set until planning completes or fails, so a rerun that
+# interrupts this block (and resumes it) can't be joined by a second Plan click
 if st.session_state.processing:
     with st.status("Planning your trip...", expanded=True) as status:
         user_input = st.session_state.user_input
         try:
-            # Execute agents sequentially
-            st.write("⏳ Creating itinerary...")
-            st.session_state.results['itinerary'] = planner_agent(user_input)
-            
-            st.write("🎭 Finding experiences...")
-            st.session_state.results['experiences'] = experience_agent(user_input)
-            
-            st.write("🏨 Selecting accommodations...")
-            st.session_state.results['recommendations'] = recommendation_agent(user_input)
+            plan = None
+            if single_request:
+                st.write("🧳 Planning every section in one request...")
+                plan = asyncio.run(run_single_request(user_input))
             
-            st.write("⚠️ Checking safety...")
-            st.session_state.results['safety'] = safety_agent(user_input)
-            
-            st.write("💰 Calculating budget...")
-            budget_result = budget_agent(user_input)
-            # Split budget and packing if possible
-            if "Packing List" in budget_result:
-                parts = budget_result.split("# Packing List")
-                st.session_state.results['budget'] = parts[0]
-                st.session_state.results['packing'] = "# Packing List" + parts[1] if len(parts) > 1 else ""
+            if plan is not None:
+                st.session_state.results.update(plan)
             else:
-                st.session_state.results['budget'] = budget_result
-                st.session_state.results['packing'] = "Packing list not generated"
+                # Execute agents concurrently, streaming each into its own placeholder
+                # and ticking off its status line as soon as it completes
+                steps = {
+                    'itinerary': ("⏳ Creating itinerary...", "✅ Itinerary ready"),
+                    'experiences': ("🎭 Finding experiences...", "✅ Experiences ready"),
+                    'recommendations': ("🏨 Selecting accommodations...", "✅ Accommodations ready"),
+                    'safety': ("⚠️ Checking safety...", "✅ Safety check ready"),
+                    'budget': ("💰 Calculating budget...", "✅ Budget ready"),
+                }
+                progress, placeholders = {}, {}
+                for name, (pending, _) in steps.items():
+                    progress[name] = st.empty()
+                    progress[name].write(pending)
+                    placeholders[name] = st.empty()
+                agent_results = asyncio.run(run_agents(
+                    user_input, placeholders, st.session_state.agent_results,
+                    on_done=lambda name: progress[name].write(steps[name][1]),
+                    max_parallel=st.session_state.max_parallel
+                ))
+                # Failed calls are not remembered, so they are retried next time
+                st.session_state.agent_results = {
+                    name: entry for name, entry in agent_results.items()
+                    if not entry[1].startswith("Error:")
+                }
+                for name, (_, result) in agent_results.items():
+                    st.session_state.results[name] = result
+                budget_result = st.session_state.results['budget']
+            
+                # Split budget and packing if possible
+                (
+                    st.session_state.results['budget'],
+                    st.session_state.results['packing'],
+                ) = split_budget_and_packing(budget_result)
             
             status.update(label="Trip plan ready! 🎉", state="complete")
             st.session_state.processing = False
+            st.session_state.in_flight = False
             st.rerun()
             
         except Exception as e:
             st.error(f"Planning failed: {str(e)}")
             st.session_state.processing = False
+            st.session_state.in_flight = False
             status.update(label="Planning failed", state="error")
             logger.exception("Planning failed")
 
@@ -293,7 +823,7 @@ if st.session_state.results:
     
     st.download_button(
         "Download Full Plan", 
-        json.dumps(st.session_state.results, indent=2), 
+        _encode_results(tuple(st.session_state.results.items())), 
         file_name="travel_plan.json",
         mime="application/json"
     )
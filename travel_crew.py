@@ -1,17 +1,34 @@
 import os
 import time
 import json
+import asyncio
+import hashlib
+import re
 import logging
+import threading
+import httpx
+import orjson
 import requests
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
-from typing import Dict, List, Any
+from typing import Callable, Dict, List, Any, Optional, Tuple
+from functools import lru_cache
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
 from crewai import Agent, Task, Crew, Process, LLM
+from chromadb import Documents, EmbeddingFunction, Embeddings
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Agent/crew tracing is off unless CREW_VERBOSE=1; it prints every step of all
+# concurrently running tasks to the console
+VERBOSE = os.getenv("CREW_VERBOSE", "0") == "1"
+if not VERBOSE:
+    logging.getLogger("crewai").setLevel(logging.WARNING)
+
 # Initialize session state
 if 'results' not in st.session_state:
     st.session_state.results = {}
@@ -19,45 +36,202 @@ if 'processing' not in st.session_state:
     st.session_state.processing = False
 
 # Ollama configuration
-OLLAMA_MODEL = "ollama/llama3.2:latest"
+# Explicit 4-bit quant: decoding is memory-bandwidth bound, so fewer bytes per
+# weight means more tokens per second
+OLLAMA_MODEL = "ollama/llama3.2:3b-instruct-q4_K_M"
 OLLAMA_BASE_URL = "http://localhost:11434"
+# How long Ollama keeps the model loaded after the last request
+OLLAMA_KEEP_ALIVE = "30m"
+# Time budget per task, in seconds (CREW_TASK_TIMEOUT). A plan gets this much
+# per task because Ollama may run the tasks one after another; CPU-only
+# servers often need several minutes per section.
+try:
+    TASK_TIMEOUT_SECONDS = max(int(os.getenv("CREW_TASK_TIMEOUT", "300")), 1)
+except ValueError:
+    logger.warning(f"Ignoring non-integer CREW_TASK_TIMEOUT={os.environ['CREW_TASK_TIMEOUT']!r}")
+    TASK_TIMEOUT_SECONDS = 300
+# How often partial task output is redrawn while the tasks stream
+STREAM_POLL_SECONDS = 0.25
+# How long a finished plan is served from cache for identical inputs
+PLAN_CACHE_TTL_SECONDS = 24 * 3600
+# Crew memory (short/long-term + entity) is opt-in: long-term memory adds an
+# evaluation LLM call after every task
+CREW_MEMORY = os.getenv("CREW_MEMORY", "0") == "1"
+OLLAMA_EMBED_MODEL = "nomic-embed-text"
+# How long a healthy Ollama probe is trusted while the trip inputs are unchanged
+HEALTH_RECHECK_SECONDS = 30
+# Plan sections, one per task, in task order
+PLAN_SECTIONS = ('itinerary', 'experiences', 'recommendations', 'safety', 'budget')
+
+
+class StreamingOllamaLLM(LLM):
+    """CrewAI LLM that streams Ollama chat completions into the task's sink
+
+    Falls back to the regular LiteLLM path for tool calls or when no sink is set.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Per-thread list that the running task's generated text is streamed into,
+        # set by _kickoff_streaming for the duration of each kickoff. It lives on
+        # the instance because get_llm hands the same instance to later reruns,
+        # whose module globals are a fresh namespace.
+        self.stream_sink = threading.local()
+
+    def call(self, messages, tools=None, callbacks=None, available_functions=None, **kwargs):
+        chunks = getattr(self.stream_sink, "chunks", None)
+        if chunks is None or tools:
+            return super().call(messages, tools=tools, callbacks=callbacks,
+                                available_functions=available_functions, **kwargs)
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+        options = {"stop": self.stop} if self.stop else {}
+        if self.temperature is not None:
+            options["temperature"] = self.temperature
+
+        # A new call (e.g. a retry after an unparsable answer) replaces what was shown
+        chunks.clear()
+        with get_http_session().post(
+            f"{OLLAMA_BASE_URL}/api/chat",
+            json={"model": self.model.removeprefix("ollama/"), "messages": messages,
+                  "options": options, "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE},
+            stream=True,
+            timeout=(5, TASK_TIMEOUT_SECONDS)
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = orjson.loads(line)
+                if "error" in event:
+                    # Surface Ollama's message instead of CrewAI's generic empty-response error
+                    raise RuntimeError(f"Ollama error: {event['error']}")
+                chunks.append(event.get("message", {}).get("content", ""))
+                if event.get("done"):
+                    break
+        return "".join(chunks)
+
+def partial_answer(chunks: List[str]) -> str:
+    """Displayable part of a streamed agent reply: the text after 'Final Answer:'"""
+    text = "".join(chunks)
+    return text.partition("Final Answer:")[2].lstrip() if "Final Answer:" in text else ""
+
 # Ensure the shared_llm is correctly initialized as a CrewAI LLM instance
 # The LLM class in CrewAI does not take base_url directly in its constructor for Ollama.
 # It expects the model name. CrewAI handles the Ollama connection via environment variables or direct config if needed.
 # For simplicity and common use, ensure Ollama is running and accessible.
 # If you need to explicitly set base_url for CrewAI's LLM with Ollama, you might need a custom LLM integration or
 # rely on CrewAI's internal Ollama handling (often through model mapping or env vars).
-# However, for a basic setup with "ollama/llama3.2:latest", this generally works if Ollama is running.
-shared_llm = LLM(model=OLLAMA_MODEL) # Simplified for typical CrewAI Ollama integration
+# However, for a basic setup with "ollama/llama3.2:3b-instruct-q4_K_M", this generally works if Ollama is running.
+@st.cache_resource(show_spinner=False)
+def get_llm(model: str) -> LLM:
+    """Build the CrewAI LLM client for a model once and reuse it across reruns"""
+    return StreamingOllamaLLM(model=model, keep_alive=OLLAMA_KEEP_ALIVE)
+
+shared_llm = get_llm(OLLAMA_MODEL) # Simplified for typical CrewAI Ollama integration
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Pooled session for Ollama API calls, kept across reruns"""
+    session = requests.Session()
+    # One connection per concurrently streaming task, plus the model warm-up
+    # and the memory embedder
+    session.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=len(PLAN_SECTIONS) + 2))
+    return session
+
+class CachedOllamaEmbedder(EmbeddingFunction):
+    """Local Ollama embedding function for CrewAI memory, memoized on the exact text"""
+
+    def __init__(self, model: str = OLLAMA_EMBED_MODEL):
+        self.model = model
+        # Bound per instance so the cache lives as long as the cached embedder
+        self._embed = lru_cache(maxsize=1024)(self._embed_uncached)
+
+    def _embed_uncached(self, text: str) -> Tuple[float, ...]:
+        response = get_http_session().post(
+            f"{OLLAMA_BASE_URL}/api/embeddings",
+            json={"model": self.model, "prompt": text},
+            timeout=30
+        )
+        response.raise_for_status()
+        return tuple(response.json()["embedding"])
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [list(self._embed(text)) for text in input]
 
-# Function to get available Ollama models
-def get_ollama_models() -> List[str]:
-    """Fetch available models from Ollama API"""
+@st.cache_resource(show_spinner=False)
+def get_embedder() -> Dict[str, Any]:
+    """CrewAI embedder config backed by one cached embedder, kept across reruns"""
+    return {"provider": "custom", "config": {"embedder": CachedOllamaEmbedder()}}
+
+_QUANT_RE = re.compile(r"I?Q(\d+)|B?F(\d+)")
+
+def _quant_bits(level: str) -> int:
+    """Bits per weight of an Ollama quantization level such as IQ2_XS, Q4_K_M or BF16"""
+    match = _QUANT_RE.match(level)
+    return int(match.group(1) or match.group(2)) if match else 99
+
+async def fetch_ollama_models() -> Optional[List[str]]:
+    """Fetch available models from Ollama API, or None if Ollama is unreachable"""
+    # A client is bound to the event loop it was used on, so each asyncio.run
+    # gets its own. Plain-http Ollama negotiates HTTP/1.1; http2 applies over TLS.
+    async with httpx.AsyncClient(base_url=OLLAMA_BASE_URL, timeout=5.0, http2=True) as client:
+        try:
+            response = await client.get("/api/tags")
+            response.raise_for_status()
+            models_data = orjson.loads(response.content)
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            logger.error(f"Ollama health check failed: {e}")
+            return None
+    models = models_data.get('models', [])
+    # Lowest-precision quants first, so the fastest variants lead the list
+    models.sort(key=lambda model: _quant_bits(model.get('details', {}).get('quantization_level', '')))
+    return [f"ollama/{model['name']}" for model in models]
+
+# Check if Ollama is running and list its models
+@st.cache_data(ttl=10, show_spinner=False)
+def probe_ollama() -> Tuple[bool, List[str]]:
+    """Check Ollama health and list its models with one /api/tags round-trip"""
+    models = asyncio.run(fetch_ollama_models())
+    # Fallback to default if fetching fails, ensuring at least one model is available
+    return models is not None, models or [OLLAMA_MODEL]
+
+@st.cache_resource(show_spinner=False)
+def get_probe_executor() -> ThreadPoolExecutor:
+    """Worker for the startup Ollama probe, kept across reruns"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="ollama-probe")
+
+def _warm_model(model: str) -> None:
+    """Load the model into Ollama ahead of the first task"""
+    # An empty prompt only loads the model; keep_alive keeps it resident
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
-        response.raise_for_status()
-        models_data = response.json()
-        return [f"ollama/{model['name']}" for model in models_data.get('models', [])]
-    except Exception as e:
-        logger.error(f"Failed to fetch models: {str(e)}")
-        # Fallback to default if fetching fails, ensuring at least one model is available
-        return [OLLAMA_MODEL]
+        get_http_session().post(
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json={"model": model.removeprefix("ollama/"), "prompt": "", "stream": False,
+                  "keep_alive": OLLAMA_KEEP_ALIVE},
+            timeout=30
+        ).raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Warm-up of {model} failed: {e}")
+
+@st.cache_resource(show_spinner=False)
+def get_warmup_executor() -> ThreadPoolExecutor:
+    """Worker for model warm-ups, kept across reruns so it outlives the click's run"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="ollama-warmup")
 
 # Agent definitions
 def create_agents(model: str):
     """Create CrewAI agents with the specified model"""
-    # Create a new LLM instance with the selected model
-    # It's better to pass the model string directly to the LLM constructor for CrewAI
-    # shared_llm already uses OLLAMA_MODEL, if selected_model is different, you'd re-initialize
-    # For now, let's assume selected_model is indeed OLLAMA_MODEL from sidebar
-    agent_llm = LLM(model=model)
+    # Only the LLM client is cached: kickoff rebinds each agent's crew and
+    # executor, so agents must not be shared between concurrent plans
+    agent_llm = get_llm(model)
 
     planner = Agent(
         role='Senior Travel Planner',
         goal='Create personalized travel itineraries',
         backstory="Expert travel planner with 20+ years experience crafting perfect schedules",
         llm=agent_llm,
-        verbose=True
+        verbose=VERBOSE
     )
 
     experience = Agent(
@@ -65,7 +239,7 @@ def create_agents(model: str):
         goal='Recommend unique local experiences and cultural activities',
         backstory="Cultural anthropologist and world traveler with deep local knowledge",
         llm=agent_llm,
-        verbose=True
+        verbose=VERBOSE
     )
 
     recommendation = Agent(
@@ -73,7 +247,7 @@ def create_agents(model: str):
         goal='Suggest accommodations, transportation, and dining options',
         backstory="Former five-star hotel manager with premium service connections",
         llm=agent_llm,
-        verbose=True
+        verbose=VERBOSE
     )
 
     safety = Agent(
@@ -81,7 +255,7 @@ def create_agents(model: str):
         goal='Provide safety information and travel advisories',
         backstory="Ex-government security specialist with 15 years in travel risk management",
         llm=agent_llm,
-        verbose=True
+        verbose=VERBOSE
     )
 
     budget = Agent(
@@ -89,129 +263,143 @@ def create_agents(model: str):
         goal='Create budget estimates and packing suggestions',
         backstory="Financial planner specializing in travel economics",
         llm=agent_llm,
-        verbose=True
+        verbose=VERBOSE
     )
 
     return planner, experience, recommendation, safety, budget
 
+# Task description templates, filled per request with str.format(**user_input)
+ITINERARY_TEMPLATE = """Create a detailed {duration}-day itinerary for a trip from {start_date} to {end_date}.
+Destination: {destination}
+Travelers: {num_people} {traveler_type} travelers
+Special requests: {special_requests}
+
+Output format:
+# Travel Itinerary for {destination}
+## Day 1: [Date]
+- [Time]: [Activity]
+- [Time]: [Activity]
+...
+Ensure the output is pure markdown, with no extra text or explanations.
+"""
+
+EXPERIENCE_TEMPLATE = """Recommend unique and local activities in {destination} for {traveler_type} travelers. Focus on cultural, adventure, and local experiences.
+Special requests: {special_requests}
+
+Output format:
+# Local Experiences in {destination}
+## Must-Try Activities
+- [Activity 1]: [Description]
+- [Activity 2]: [Description]
+
+## Cultural Experiences
+- [Experience 1]: [Description]
+- [Experience 2]: [Description]
+Ensure the output is pure markdown, with no extra text or explanations.
+"""
+
+RECOMMENDATION_TEMPLATE = """Recommend hotels, transportation, and dining options in {destination} for {num_people} {traveler_type} travelers.
+Budget level: {budget_level}
+
+Output format:
+# Accommodations & Transport
+## Hotels
+- [Hotel Option 1]: [Price range], [Features], [Location]
+- [Hotel Option 2]: [Price range], [Features], [Location]
+
+## Transportation
+- [Transport Option 1]: [Description]
+- [Transport Option 2]: [Description]
+
+## Dining Suggestions
+- [Restaurant Name 1]: [Cuisine], [Price range], [Notes based on special requests]
+- [Restaurant Name 2]: [Cuisine], [Price range], [Notes based on special requests]
+Ensure the output is pure markdown, with no extra text or explanations.
+"""
+
+SAFETY_TEMPLATE = """Provide comprehensive safety tips and travel advisories for {destination} for the period {start_date} to {end_date}. Include health recommendations and essential emergency contacts.
+
+Output format:
+# Safety Information for {destination}
+## Travel Advisories
+- [Advisory 1]: [Details]
+- [Advisory 2]: [Details]
+
+## Health Recommendations
+- [Recommendation 1]: [Details]
+- [Recommendation 2]: [Details]
+
+## Emergency Contacts
+- [Contact Name/Service 1]: [Number]
+- [Contact Name/Service 2]: [Number]
+Ensure the output is pure markdown, with no extra text or explanations.
+"""
+
+BUDGET_TEMPLATE = """Estimate costs for {num_people} people traveling to {destination} for {duration} days, considering a {budget_level} budget.
+Also, suggest a comprehensive packing list based on the destination and travel dates.
+
+Output format:
+# Budget Estimate for {destination} Trip
+## Cost Breakdown (Estimates)
+- Accommodation: [Estimate per person/total, e.g., $X/night or $Y total]
+- Transportation: [Estimate per person/total]
+- Food & Dining: [Estimate per person/total]
+- Activities/Experiences: [Estimate per person/total]
+- Miscellaneous: [Estimate per person/total]
+- **Total Estimated Cost:** [Total Estimate]
+
+# Packing List for {destination} Trip
+## Clothing
+- [Item 1]
+- [Item 2]
+## Essentials
+- [Item 1]
+- [Item 2]
+## Health & Safety
+- [Item 1]
+- [Item 2]
+Ensure the output is pure markdown, with no extra text or explanations.
+"""
+
+# Single-request prompt: every task template, answered as one JSON object
+SINGLE_SHOT_TEMPLATE = """Plan a trip by answering the five briefs below.
+Respond with a single JSON object with exactly these keys: {keys}.
+Each value must be the complete markdown answer to the matching brief, as a string.
+
+"""
+
+
 # Create tasks
 def create_tasks(user_input: Dict[str, Any], agents: tuple):
     """Create CrewAI tasks based on user input"""
     planner, experience, recommendation, safety, budget = agents
 
     itinerary_task = Task(
-        description=f"""Create a detailed {user_input['duration']}-day itinerary for a trip from {
-            user_input['start_date']} to {user_input['end_date']}.
-        Destination: {user_input['destination']}
-        Travelers: {user_input['num_people']} {user_input['traveler_type']} travelers
-        Special requests: {user_input['special_requests']}
-
-        Output format:
-        # Travel Itinerary for {user_input['destination']}
-        ## Day 1: [Date]
-        - [Time]: [Activity]
-        - [Time]: [Activity]
-        ...
-        Ensure the output is pure markdown, with no extra text or explanations.
-        """,
+        description=ITINERARY_TEMPLATE.format(**user_input),
         agent=planner,
         expected_output="Markdown formatted daily itinerary"
     )
 
     experience_task = Task(
-        description=f"""Recommend unique and local activities in {user_input['destination']} for {
-            user_input['traveler_type']} travelers. Focus on cultural, adventure, and local experiences.
-        Special requests: {user_input['special_requests']}
-
-        Output format:
-        # Local Experiences in {user_input['destination']}
-        ## Must-Try Activities
-        - [Activity 1]: [Description]
-        - [Activity 2]: [Description]
-
-        ## Cultural Experiences
-        - [Experience 1]: [Description]
-        - [Experience 2]: [Description]
-        Ensure the output is pure markdown, with no extra text or explanations.
-        """,
+        description=EXPERIENCE_TEMPLATE.format(**user_input),
         agent=experience,
         expected_output="Curated list of experiences with descriptions in markdown"
     )
 
     recommendation_task = Task(
-        description=f"""Recommend hotels, transportation, and dining options in {user_input['destination']} for {
-            user_input['num_people']} {user_input['traveler_type']} travelers.
-        Budget level: {user_input['budget_level']}
-
-        Output format:
-        # Accommodations & Transport
-        ## Hotels
-        - [Hotel Option 1]: [Price range], [Features], [Location]
-        - [Hotel Option 2]: [Price range], [Features], [Location]
-
-        ## Transportation
-        - [Transport Option 1]: [Description]
-        - [Transport Option 2]: [Description]
-
-        ## Dining Suggestions
-        - [Restaurant Name 1]: [Cuisine], [Price range], [Notes based on special requests]
-        - [Restaurant Name 2]: [Cuisine], [Price range], [Notes based on special requests]
-        Ensure the output is pure markdown, with no extra text or explanations.
-        """,
+        description=RECOMMENDATION_TEMPLATE.format(**user_input),
         agent=recommendation,
         expected_output="Structured recommendations with options for hotels, transport, and dining in markdown"
     )
 
     safety_task = Task(
-        description=f"""Provide comprehensive safety tips and travel advisories for {user_input['destination']} for the period {
-            user_input['start_date']} to {user_input['end_date']}. Include health recommendations and essential emergency contacts.
-
-        Output format:
-        # Safety Information for {user_input['destination']}
-        ## Travel Advisories
-        - [Advisory 1]: [Details]
-        - [Advisory 2]: [Details]
-
-        ## Health Recommendations
-        - [Recommendation 1]: [Details]
-        - [Recommendation 2]: [Details]
-
-        ## Emergency Contacts
-        - [Contact Name/Service 1]: [Number]
-        - [Contact Name/Service 2]: [Number]
-        Ensure the output is pure markdown, with no extra text or explanations.
-        """,
+        description=SAFETY_TEMPLATE.format(**user_input),
         agent=safety,
         expected_output="Safety briefing document with categorized information in markdown"
     )
 
     budget_task = Task(
-        description=f"""Estimate costs for {user_input['num_people']} people traveling to {
-            user_input['destination']} for {user_input['duration']} days, considering a {user_input['budget_level']} budget.
-            Also, suggest a comprehensive packing list based on the destination and travel dates.
-
-        Output format:
-        # Budget Estimate for {user_input['destination']} Trip
-        ## Cost Breakdown (Estimates)
-        - Accommodation: [Estimate per person/total, e.g., $X/night or $Y total]
-        - Transportation: [Estimate per person/total]
-        - Food & Dining: [Estimate per person/total]
-        - Activities/Experiences: [Estimate per person/total]
-        - Miscellaneous: [Estimate per person/total]
-        - **Total Estimated Cost:** [Total Estimate]
-
-        # Packing List for {user_input['destination']} Trip
-        ## Clothing
-        - [Item 1]
-        - [Item 2]
-        ## Essentials
-        - [Item 1]
-        - [Item 2]
-        ## Health & Safety
-        - [Item 1]
-        - [Item 2]
-        Ensure the output is pure markdown, with no extra text or explanations.
-        """,
+        description=BUDGET_TEMPLATE.format(**user_input),
         agent=budget,
         expected_output="Budget breakdown and categorized packing list in markdown"
     )
@@ -219,6 +407,221 @@ def create_tasks(user_input: Dict[str, Any], agents: tuple):
     return itinerary_task, experience_task, recommendation_task, safety_task, budget_task
 
 
+def _kickoff_streaming(crew: Crew, chunks: List[str]):
+    """Kick off a crew with its LLM calls streaming into `chunks`"""
+    # Duck-typed: an LLM cached by an earlier rerun is an instance of that run's class
+    sinks = [agent.llm.stream_sink for agent in crew.agents if hasattr(agent.llm, "stream_sink")]
+    for sink in sinks:
+        sink.chunks = chunks
+    try:
+        return crew.kickoff()
+    finally:
+        for sink in sinks:
+            sink.chunks = None
+
+
+class TaskRun:
+    """Each task of one plan kicked off in its own single-task crew, concurrently
+
+    None of the tasks consumes another's output, so they run side by side and
+    wall-clock time is bounded by the slowest one. A task that fails or times
+    out gets an error message for its section instead of failing the whole plan.
+    The crews keep running in the background if the script run collecting them
+    is interrupted, so a later rerun can pick them up again with collect().
+    """
+
+    def __init__(self, agents: tuple, tasks: tuple):
+        self.results = {}
+        self.executor = ThreadPoolExecutor(max_workers=len(tasks))
+        self.futures = {}
+        self.streams = {section: [] for section in PLAN_SECTIONS}
+        for section, agent, task in zip(PLAN_SECTIONS, agents, tasks):
+            crew = Crew(
+                agents=[agent],
+                tasks=[task],
+                process=Process.sequential,
+                verbose=VERBOSE, # Set CREW_VERBOSE=1 to trace agents in the console
+                memory=CREW_MEMORY,
+                embedder=get_embedder() if CREW_MEMORY else None
+            )
+            self.futures[self.executor.submit(_kickoff_streaming, crew, self.streams[section])] = section
+        # Counted from submit, so it includes time queued behind the other tasks
+        self.timeout = TASK_TIMEOUT_SECONDS * len(tasks)
+        self.deadline = time.monotonic() + self.timeout
+
+    def collect(self, on_result: Optional[Callable[[str, str], None]] = None,
+                on_partial: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
+        """Wait for every task and return the results in PLAN_SECTIONS order
+
+        `on_result(section, text)` is called from the calling thread as each task finishes
+        (and first for sections an interrupted earlier call already collected), and
+        `on_partial(section, text)` with the answer generated so far while it runs.
+        """
+        if on_result is not None:
+            for section, text in self.results.items():
+                on_result(section, text)
+        shown = {}
+        pending = {future for future, section in self.futures.items() if section not in self.results}
+        while pending:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Wake up a few times a second to show the partial answers
+            done, pending = wait(pending, timeout=min(STREAM_POLL_SECONDS, remaining),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                section = self.futures[future]
+                try:
+                    self.results[section] = future.result().raw
+                except Exception as e:
+                    logger.exception(f"CrewAI task '{section}' failed")
+                    self.results[section] = f"Error: {section} generation failed: {e}"
+                if on_result is not None:
+                    on_result(section, self.results[section])
+            if on_partial is not None:
+                for future in pending:
+                    section = self.futures[future]
+                    text = partial_answer(self.streams[section])
+                    if text and text != shown.get(section):
+                        shown[section] = text
+                        on_partial(section, text)
+        for future in pending:
+            section = self.futures[future]
+            logger.error(f"CrewAI task '{section}' timed out")
+            self.results[section] = f"Error: {section} generation timed out after {self.timeout}s"
+        self.abandon()
+        return {section: self.results[section] for section in PLAN_SECTIONS}
+
+    def abandon(self) -> None:
+        """Drop tasks that haven't started; a running kickoff can't be interrupted"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def single_shot_plan(user_input: Dict[str, Any], model: str) -> Dict[str, str]:
+    """Generate all plan sections with one Ollama chat request in JSON mode
+
+    Raises requests.RequestException on transport errors and ValueError when
+    the reply is not a JSON object with a non-empty string for every section.
+    """
+    briefs = zip(PLAN_SECTIONS, (ITINERARY_TEMPLATE, EXPERIENCE_TEMPLATE, RECOMMENDATION_TEMPLATE,
+                                 SAFETY_TEMPLATE, BUDGET_TEMPLATE))
+    prompt = SINGLE_SHOT_TEMPLATE.format(keys=", ".join(PLAN_SECTIONS)) + "\n".join(
+        f"## Brief for \"{section}\"\n{template.format(**user_input)}" for section, template in briefs
+    )
+    response = get_http_session().post(
+        f"{OLLAMA_BASE_URL}/api/chat",
+        json={
+            "model": model.removeprefix("ollama/"),
+            "messages": [{"role": "user", "content": prompt}],
+            "format": "json",
+            "stream": False
+        },
+        # One request generates every section
+        timeout=TASK_TIMEOUT_SECONDS * len(PLAN_SECTIONS)
+    )
+    response.raise_for_status()
+    plan = json.loads(response.json()["message"]["content"])
+    if not isinstance(plan, dict):
+        raise ValueError("single-shot reply is not a JSON object")
+    missing = [s for s in PLAN_SECTIONS if not isinstance(plan.get(s), str) or not plan[s].strip()]
+    if missing:
+        raise ValueError(f"single-shot reply is missing sections: {', '.join(missing)}")
+    return {section: plan[section].strip() for section in PLAN_SECTIONS}
+
+
+def plan_key(user_input: Dict[str, Any]) -> str:
+    """Hash the normalized trip inputs into a stable plan cache key"""
+    normalized = {k: v.strip() if isinstance(v, str) else v for k, v in user_input.items()}
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def get_plan_cache() -> Tuple[TTLCache, threading.Lock]:
+    """Finished plans shared across sessions, keyed by (plan key, model)"""
+    return TTLCache(maxsize=128, ttl=PLAN_CACHE_TTL_SECONDS), threading.Lock()
+
+
+def run_plan(key: str, user_input: Dict[str, Any], model: str,
+             on_result: Optional[Callable[[str, str], None]] = None,
+             single_shot: bool = False,
+             on_partial: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
+    """Run the whole planning pipeline, serving identical trips from the plan cache
+
+    With `single_shot`, one JSON-mode request is tried first and the CrewAI
+    agents are only used if it fails. Crews left running by an interrupted
+    script run (e.g. a widget change mid-plan) are re-attached to instead of
+    started again. Plans with a failed section are returned but not cached,
+    so they are retried.
+    """
+    cache, lock = get_plan_cache()
+    with lock:
+        cached = cache.get((key, model))
+    if cached is not None:
+        logger.info(f"Serving cached plan {key[:8]} for {model}")
+        return dict(cached)
+
+    run_key = (key, model)
+    active = st.session_state.get('crew_run')
+    if active is not None and active[0] != run_key:
+        # A different plan was requested; don't start the old one's queued tasks
+        active[1].abandon()
+        del st.session_state.crew_run
+        active = None
+
+    results = None
+    if single_shot and active is None:
+        try:
+            results = single_shot_plan(user_input, model)
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logger.warning(f"Single-shot plan failed, falling back to CrewAI: {e}")
+        else:
+            if on_result is not None:
+                for section, text in results.items():
+                    on_result(section, text)
+
+    if results is None:
+        if active is not None:
+            logger.info(f"Re-attaching to in-flight plan {key[:8]} for {model}")
+            run = active[1]
+        else:
+            agents = create_agents(model)
+            run = TaskRun(agents, create_tasks(user_input, agents))
+            st.session_state.crew_run = (run_key, run)
+        results = run.collect(on_result, on_partial)
+        del st.session_state.crew_run
+    if not any(result.startswith("Error:") for result in results.values()):
+        with lock:
+            cache[(key, model)] = dict(results)
+    return results
+
+
+# Result tabs, in PLAN_SECTIONS order
+RESULT_TABS = [
+    "📅 Itinerary", "🎭 Experiences", "🏨 Accommodations",
+    "⚠️ Safety", "💰 Budget & Packing"
+]
+
+PACKING_LIST_MARKER = "# Packing List"
+
+def _split_budget_and_packing(raw: str) -> Tuple[str, str]:
+    """Split the budget task's output into (budget, packing list)"""
+    budget, marker, packing = raw.partition(PACKING_LIST_MARKER)
+    if not marker:
+        # If the marker isn't found, assume the budget part is the whole string
+        return raw, "Packing list section not found in budget output."
+    return budget.strip(), (marker + packing).strip()
+
+
+@st.cache_data(show_spinner=False)
+def _render_downloads(results_items: Tuple[Tuple[str, Any], ...]) -> Tuple[bytes, bytes]:
+    """Render the plan as (markdown, JSON) download bytes"""
+    # Items are passed in section order (not sorted) so the markdown reads in plan order
+    sections = [v for _, v in results_items if isinstance(v, str)]
+    md_bytes = "\n\n---\n\n".join(sections).encode()
+    json_bytes = orjson.dumps(dict(results_items), option=orjson.OPT_INDENT_2)
+    return md_bytes, json_bytes
+
+
 # Streamlit UI Setup
 st.set_page_config(
     page_title="AI Travel Assistant",
@@ -230,27 +633,70 @@ st.set_page_config(
     }
 )
 
+# Reruns from tab clicks and other widgets reuse this session's last healthy
+# probe for a while; otherwise start the probe now so it overlaps with drawing
+# the page, and only await it where it is first needed
+last_probe = st.session_state.get('ollama_probe')
+if last_probe is not None and time.time() - st.session_state.ollama_probe_at < HEALTH_RECHECK_SECONDS:
+    f_probe = None
+else:
+    f_probe = get_probe_executor().submit(probe_ollama)
+
+# Inputs are locked while a plan is running, so editing them can't interrupt it
+# with a rerun that plans something else
+inputs_locked = st.session_state.processing
+
 # Sidebar - Model Selection
 with st.sidebar:
     st.header("🧠 AI Model Settings")
 
     # Get available models
-    available_models = get_ollama_models()
-    # Ensure OLLAMA_MODEL is always in available_models for consistent initial selection
-    if OLLAMA_MODEL not in available_models:
-        available_models.insert(0, OLLAMA_MODEL) # Add it to the top if not found
+    if f_probe is None:
+        ollama_running, available_models = last_probe
+    else:
+        ollama_running, available_models = f_probe.result()
+        if ollama_running:
+            st.session_state.ollama_probe = (ollama_running, available_models)
+            st.session_state.ollama_probe_at = time.time()
+    # Copied so the list stored for later reruns only holds installed models
+    available_models = list(available_models)
+    default_model = OLLAMA_MODEL
+    pinned_missing = ollama_running and OLLAMA_MODEL not in available_models
+    if pinned_missing:
+        # Prefer an installed llama3.2 variant (e.g. from `ollama run llama3.2`)
+        # over the pinned tag, which would fail every task until it is pulled
+        installed_llama = [m for m in available_models if m.startswith("ollama/llama3.2")]
+        if installed_llama:
+            default_model = installed_llama[0]
+    # Ensure the default is always in available_models for consistent initial selection
+    if default_model not in available_models:
+        available_models.insert(0, default_model) # Add it to the top if not found
 
     selected_model = st.selectbox(
         "Choose AI Model",
         available_models,
-        index=available_models.index(OLLAMA_MODEL) if OLLAMA_MODEL in available_models else 0
+        index=available_models.index(default_model),
+        disabled=inputs_locked
     )
     st.caption(f"Selected: {selected_model}")
+    if pinned_missing and selected_model == OLLAMA_MODEL:
+        st.warning(f"`{OLLAMA_MODEL.removeprefix('ollama/')}` is not pulled yet. "
+                   f"Run `ollama pull {OLLAMA_MODEL.removeprefix('ollama/')}` or choose another model.")
 
     if st.button("Refresh Models"):
-        # This will re-run the script, causing get_ollama_models to be called again
+        # Drop the cached model list so the rerun fetches it from Ollama again
+        probe_ollama.clear()
+        st.session_state.pop('ollama_probe', None)
         st.rerun()
 
+    single_shot = st.toggle(
+        "Single-request mode",
+        value=False,
+        help="Ask the model for the whole plan in one JSON response instead of running "
+             "the five agents. Faster, but smaller models may return incomplete sections, "
+             "in which case the agents are used instead."
+    )
+
     st.divider()
 
 # Sidebar - Trip Details
@@ -260,24 +706,28 @@ with st.sidebar:
 
     col1, col2 = st.columns(2)
     with col1:
-        start_date = st.date_input("Start Date", value=today)
+        start_date = st.date_input("Start Date", value=today, disabled=inputs_locked)
     with col2:
-        end_date = st.date_input("End Date", value=today + timedelta(days=7))
+        end_date = st.date_input("End Date", value=today + timedelta(days=7), disabled=inputs_locked)
 
-    from_location = st.text_input("Departing From", "New York")
-    destination = st.text_input("Destination", "Paris, France")
-    num_people = st.number_input("Number of Travelers", 1, 20, 2)
+    from_location = st.text_input("Departing From", "New York", disabled=inputs_locked)
+    destination = st.text_input("Destination", "Paris, France", disabled=inputs_locked)
+    num_people = st.number_input("Number of Travelers", 1, 20, 2, disabled=inputs_locked)
     traveler_type = st.selectbox("Traveler Type", [
         "Solo", "Couple", "Family with Kids", "Friends Group",
         "Business", "Adventure Seekers", "Luxury Travelers"
-    ])
-    budget_level = st.selectbox("Budget Level", ["Budget", "Mid-range", "Luxury"])
-    special_requests = st.text_area("Special Requirements", "Vegetarian food, accessible locations")
+    ], disabled=inputs_locked)
+    budget_level = st.selectbox("Budget Level", ["Budget", "Mid-range", "Luxury"], disabled=inputs_locked)
+    special_requests = st.text_area("Special Requirements", "Vegetarian food, accessible locations",
+                                    disabled=inputs_locked)
 
-    if st.button("Plan My Trip", use_container_width=True, type="primary"):
+    if st.button("Plan My Trip", use_container_width=True, type="primary", disabled=inputs_locked):
         if start_date >= end_date:
             st.error("End date must be after start date")
         else:
+            # Start loading the model now so it is resident by the time the
+            # agents are built and the first task reaches Ollama
+            get_warmup_executor().submit(_warm_model, selected_model)
             # Reset results when a new plan is initiated
             st.session_state.results = {}
             st.session_state.processing = True
@@ -300,20 +750,22 @@ with st.sidebar:
 st.title("AI Travel Assistant ✈️")
 st.caption(f"Your personal travel planning expert powered by Ollama's {selected_model}")
 
-# Check if Ollama is running
-def check_ollama_health():
-    try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=3) # Shorter timeout
-        return response.status_code == 200
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ollama health check failed: {e}")
-        return False
+# A stored probe is only trusted while the inputs stay the same; any change
+# re-checks that Ollama is still up before anything is planned
+ui_key = hash((from_location, destination, num_people, traveler_type, budget_level,
+               str(start_date), str(end_date), selected_model))
+if f_probe is None and ui_key != st.session_state.get('last_ui_key'):
+    ollama_running, _ = probe_ollama()
+    if not ollama_running:
+        st.session_state.pop('ollama_probe', None)
+st.session_state.last_ui_key = ui_key
 
 # Show warning if Ollama not running
-if not check_ollama_health():
+if not ollama_running:
     st.error(f"Ollama service not detected at {OLLAMA_BASE_URL}. Please ensure Ollama is running.")
-    st.info("You can download and run Ollama from [ollama.com](https://ollama.com). After installing, make sure to pull the `llama3.2` model if you haven't already by running `ollama run llama3.2` in your terminal.")
+    st.info("You can download and run Ollama from [ollama.com](https://ollama.com). After installing, make sure to pull the default model if you haven't already by running `ollama pull llama3.2:3b-instruct-q4_K_M` in your terminal.")
     if st.button("Try Again", type="secondary"):
+        probe_ollama.clear()
         st.rerun()
     st.stop() # Stop execution if Ollama is not running
 
@@ -322,45 +774,24 @@ if st.session_state.processing:
     with st.status("Planning your trip...", expanded=True) as status:
         user_input = st.session_state.user_input
         try:
-            # Create agents and tasks using the selected model
-            agents = create_agents(selected_model)
-            itinerary_task, experience_task, recommendation_task, safety_task, budget_task = create_tasks(user_input, agents)
-
-            # Form the crew
-            travel_crew = Crew(
-                agents=agents,
-                tasks=[itinerary_task, experience_task, recommendation_task, safety_task, budget_task],
-                process=Process.sequential,
-                verbose=True, # Keep verbose for debugging in console
-                memory=False
-            )
-
             st.write(f"🚀 Starting travel planning with {selected_model}...")
-            # Execute the crew
-            crew_result = travel_crew.kickoff() # crew_result typically holds the final output of the last task
-
-            # --- FIX: Extracting raw output from tasks ---
-            # Accessing .raw attribute for the actual string output
-            results = {
-                'itinerary': itinerary_task.output.raw if itinerary_task.output else "No itinerary generated.",
-                'experiences': experience_task.output.raw if experience_task.output else "No experiences generated.",
-                'recommendations': recommendation_task.output.raw if recommendation_task.output else "No recommendations generated.",
-                'safety': safety_task.output.raw if safety_task.output else "No safety info generated.",
-                'budget': budget_task.output.raw if budget_task.output else "No budget generated.",
-            }
-
-            # --- FIX: Handle packing list extraction from the raw budget string ---
-            # Now, results['budget'] is already the raw string.
-            budget_output_raw = results['budget']
-            packing_list_marker = "# Packing List"
+            # Show each section in its tab as soon as its task finishes
+            live_tabs = st.tabs(RESULT_TABS)
+            live = {section: tab.empty() for section, tab in zip(PLAN_SECTIONS, live_tabs)}
+            for placeholder in live.values():
+                placeholder.caption("Working on it...")
+
+            # Identical trips are served from cache; otherwise the five
+            # independent tasks run concurrently
+            results = run_plan(
+                plan_key(user_input), user_input, selected_model,
+                on_result=lambda section, text: live[section].markdown(text),
+                single_shot=single_shot,
+                on_partial=lambda section, text: live[section].markdown(text + " ▌")
+            )
 
-            if packing_list_marker in budget_output_raw:
-                parts = budget_output_raw.split(packing_list_marker, 1) # Split only once
-                results['budget'] = parts[0].strip() # Budget part
-                results['packing'] = packing_list_marker + parts[1].strip() # Packing list part
-            else:
-                # If the marker isn't found, assume the budget part is the whole string
-                results['packing'] = "Packing list section not found in budget output."
+            # The budget task writes the packing list after its budget section
+            results['budget'], results['packing'] = _split_budget_and_packing(results['budget'])
 
             st.session_state.results = results
             status.update(label="Trip plan ready! 🎉", state="complete")
@@ -370,6 +801,10 @@ if st.session_state.processing:
         except Exception as e:
             st.error(f"Planning failed: {str(e)}")
             st.session_state.processing = False
+            # A failed plan is not resumed by the next one
+            if 'crew_run' in st.session_state:
+                st.session_state.crew_run[1].abandon()
+                del st.session_state.crew_run
             status.update(label="Planning failed", state="error", expanded=True)
             logger.exception("CrewAI planning failed")
             # Clear results if planning failed, or show an error state
@@ -386,10 +821,7 @@ if st.session_state.results and not st.session_state.processing:
             st.session_state.results = {}
             st.rerun()
     else:
-        tabs = st.tabs([
-            "📅 Itinerary", "🎭 Experiences", "🏨 Accommodations",
-            "⚠️ Safety", "💰 Budget & Packing"
-        ])
+        tabs = st.tabs(RESULT_TABS)
 
         with tabs[0]:
             st.subheader("Daily Itinerary")
@@ -420,23 +852,23 @@ if st.session_state.results and not st.session_state.processing:
         # Retrieve user_input from session_state as it's persistent
         current_user_input = st.session_state.get('user_input', {}) # Use .get with a default empty dict for safety
 
-        # Convert results to a display-friendly JSON string for download
-        downloadable_results = {k: v for k, v in st.session_state.results.items() if isinstance(v, str)}
-
         # Use current_user_input to construct file names
         destination_name = current_user_input.get('destination', 'plan').replace(' ', '_')
         start_date_str = current_user_input.get('start_date', datetime.now().strftime('%Y-%m-%d'))
 
 
+        # Rendered once per plan; tab clicks and other reruns hit the cache
+        md_bytes, json_bytes = _render_downloads(tuple(st.session_state.results.items()))
+
         st.download_button(
             "Download Full Plan (Markdown)",
-            "\n\n---\n\n".join(downloadable_results.values()), # Join all markdown sections
+            md_bytes, # All markdown sections joined
             file_name=f"travel_plan_{destination_name}_{start_date_str}.md",
             mime="text/markdown"
         )
         st.download_button(
             "Download Full Plan (JSON)",
-            json.dumps(st.session_state.results, indent=2), # Keep JSON for full data structure
+            json_bytes, # Keep JSON for full data structure
             file_name=f"travel_plan_{destination_name}_{start_date_str}.json",
             mime="application/json"
         )
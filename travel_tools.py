@@ -2,21 +2,62 @@ from crewai.tools import BaseTool
 from langchain_community.tools import DuckDuckGoSearchRun
 import requests
 import os
+import time
+import asyncio
+from functools import lru_cache
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Pooled session so repeated tool calls reuse connections to the weather API
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+# (connect, read) timeouts in seconds
+_TIMEOUT = (2, 5)
+
+# One search client shared by every tool call
+_DDG = DuckDuckGoSearchRun()
+
+# Cache lifetimes, in seconds, for repeated tool lookups
+WEATHER_TTL = 600
+SEARCH_TTL = 3600
+
+class _WeatherAPIError(Exception):
+    """OpenWeatherMap answered with an error message instead of weather data"""
+
+# The `bucket` arguments below are time slots (time // TTL): a new slot is a new
+# cache key, so entries expire with their slot. Exceptions are never cached.
+@lru_cache(maxsize=256)
+def _search(query: str, bucket: int) -> str:
+    return _DDG.run(query)
+
+@lru_cache(maxsize=256)
+def _fetch_weather(city: str, api_key: str, bucket: int) -> str:
+    url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}&units=metric"
+    response = _SESSION.get(url, timeout=_TIMEOUT).json()
+    if response.get("cod") != 200:
+        raise _WeatherAPIError(response.get('message', 'Unknown error from OpenWeatherMap API'))
+    main = response['main']
+    weather = response['weather'][0]['description']
+    return f"{response.get('name', city)}: {main['temp']}°C, {weather}"
+
 class DuckDuckGoSearchTool(BaseTool):
     name: str = "duckduckgo_search"
     description: str = "Search the web for current events or factual information."
 
     def _run(self, query: str) -> str:
-        search = DuckDuckGoSearchRun()
-        return search.run(query)
+        return _search(query.strip(), int(time.time() // SEARCH_TTL))
 
     async def _arun(self, query: str) -> str:
-        return self._run(query)
+        # Run the blocking search in a worker thread so concurrent calls overlap
+        return await asyncio.to_thread(self._run, query)
 
 class WeatherTool(BaseTool):
     name: str = "weather_tool"
@@ -26,22 +67,17 @@ class WeatherTool(BaseTool):
         api_key = os.getenv("OPENWEATHERMAP_API_KEY")
         if not api_key:
             return "Error: OpenWeatherMap API key not found in environment variables. Please set OPENWEATHERMAP_API_KEY in your .env file."
-        url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}&units=metric"
         try:
-            response = requests.get(url).json()
-            if response.get("cod") != 200:
-                error_message = response.get('message', 'Unknown error from OpenWeatherMap API')
-                return f"Error fetching weather for {city}: {error_message}"
-            main = response['main']
-            weather = response['weather'][0]['description']
-            return f"{city}: {main['temp']}°C, {weather}"
+            return _fetch_weather(city.strip().lower(), api_key, int(time.time() // WEATHER_TTL))
+        except _WeatherAPIError as e:
+            return f"Error fetching weather for {city}: {e}"
         except requests.exceptions.RequestException as e:
             return f"Error connecting to OpenWeatherMap API: {e}"
         except KeyError:
             return "Error: Unexpected response format from OpenWeatherMap API. Check city name or API key."
 
     async def _arun(self, city: str) -> str:
-        return self._run(city)
+        return await asyncio.to_thread(self._run, city)
 
 def verify_tools():
     print("--- Verifying DuckDuckGoSearchTool ---")